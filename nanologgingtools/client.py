@@ -0,0 +1,148 @@
+"""client.py: consume loglines from a nanoprintf-server PUB socket.
+
+make_subscriber() sets up a SUB socket the way all the consumers do. AsyncSubscriber integrates
+it with asyncio through the socket receive fd and yields parsed batches of lines, so consumers
+doing I/O of their own do not stall the intake. Needs Python 3.5+.
+
+    async def forward(addr):
+        async with AsyncSubscriber(addr, hosts=["koerkana*"]) as sub:
+            async for lines in sub:
+                for line in lines:
+                    await store(line.host, line.timestr, line.text)
+"""
+
+import errno
+import asyncio
+import fnmatch
+import collections
+
+from nanomsg import Socket, SUB, SUB_SUBSCRIBE
+from nanomsg import SOL_SOCKET, RECONNECT_IVL, RECONNECT_IVL_MAX, DONTWAIT, NanoMsgAPIError
+
+__license__ = "MIT"
+
+
+LogLine = collections.namedtuple("LogLine", ["host", "seqno", "timestr", "broken", "text", "raw"])
+
+
+def make_subscriber(addr, prefixes=None, bind=False):
+    """
+    SUB socket subscribed to lines starting with any of the prefixes (all lines by default).
+    Lines start with hostname_n, so a prefix selects hosts on the server side.
+    """
+    soc_sub = Socket(SUB)
+    for prefix in prefixes or [""]:
+        soc_sub.set_string_option(SUB, SUB_SUBSCRIBE, prefix)
+    # start reconnecting after one second pause
+    # max reconnect timer to 30 seconds
+    soc_sub.set_int_option(SOL_SOCKET, RECONNECT_IVL, 1000)
+    soc_sub.set_int_option(SOL_SOCKET, RECONNECT_IVL_MAX, 1000 * 30)
+    if bind:
+        soc_sub.bind(addr)
+    else:
+        soc_sub.connect(addr)
+    return soc_sub
+
+
+def parse_line(msg):
+    """
+    "koerkana1_4 123ABC x2015-01-16T13:25:05.25Z 'N-cbuf 2B45 01 0C'"
+        -> LogLine("koerkana1_4", 0x123ABC, "2015-01-16T13:25:05.25Z", True, "N-cbuf 2B45 01 0C", msg)
+    Raises ValueError if the line is not in the nanoprintf format.
+    """
+    hostname_n, seqno, timestr, rest = msg.split(None, 3)
+    broken = timestr.startswith("x")
+    if broken:
+        timestr = timestr[1:]
+    # remove quotes
+    return LogLine(hostname_n, int(seqno, 16), timestr, broken, rest[1:-1], msg)
+
+
+class AsyncSubscriber(object):
+    """
+    Async iterator of lists of LogLines from a nanoprintf-server.
+
+    Lines are received as soon as the socket is readable and kept in a buffer of maxsize lines.
+    When the consumer falls behind, the oldest lines are dropped and counted in stats["dropped"].
+    hosts are hostname_n globs, prefixes are passed on to the SUB socket.
+    """
+
+    def __init__(self, addr, hosts=None, prefixes=None, maxsize=10000, batch=1000, bind=False, loop=None):
+        self.addr = addr
+        self.hosts = hosts
+        self.prefixes = prefixes
+        self.maxsize = maxsize
+        self.batch = batch
+        self.bind = bind
+        self.loop = loop
+        self.socket = None
+        self.buffer = collections.deque()
+        self.ready = None
+        self.stats = dict(received=0, filtered=0, errors=0, dropped=0, delivered=0, batches=0)
+
+    def open(self):
+        """ Call from a coroutine, the socket is watched by the running event loop unless loop was given. """
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()
+        self.socket = make_subscriber(self.addr, self.prefixes, self.bind)
+        self.loop.add_reader(self.socket.recv_fd, self._readable)
+
+    def close(self):
+        if self.socket is not None:
+            self.loop.remove_reader(self.socket.recv_fd)
+            self.socket.close()
+            self.socket = None
+            self.ready.set()  # wake up the consumer
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.buffer:
+            if self.socket is None:
+                raise StopAsyncIteration
+            self.ready.clear()
+            await self.ready.wait()
+
+        count = min(self.batch, len(self.buffer))
+        lines = [self.buffer.popleft() for _ in range(count)]
+        self.stats["delivered"] += count
+        self.stats["batches"] += 1
+        return lines
+
+    def _readable(self):
+        # limit the work per callback, the fd stays readable if there is more
+        for _ in range(self.maxsize):
+            try:
+                msg = self.socket.recv(flags=DONTWAIT)
+            except NanoMsgAPIError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if msg:
+                self._put(msg)
+        if self.buffer:
+            self.ready.set()
+
+    def _put(self, msg):
+        self.stats["received"] += 1
+        try:
+            line = parse_line(msg.decode("utf-8", "replace"))
+        except ValueError:
+            self.stats["errors"] += 1
+            return
+        if self.hosts and not any(fnmatch.fnmatchcase(line.host, h) for h in self.hosts):
+            self.stats["filtered"] += 1
+            return
+        if len(self.buffer) >= self.maxsize:
+            self.buffer.popleft()
+            self.stats["dropped"] += 1
+        self.buffer.append(line)
@@ -0,0 +1,90 @@
+"""floodcontrol.py: per-host token bucket rate limiting of loglines."""
+
+import time
+import array
+import fnmatch
+
+__license__ = "MIT"
+
+
+def check_burst(burst):
+    """ A bucket smaller than one token would never let a line through. """
+    if burst < 1.0:
+        raise ValueError("burst must be at least 1 line: %s" % burst)
+    return burst
+
+
+def parse_limit(spec):
+    """ "koerkana1_*=50:200" -> ("koerkana1_*", 50.0, 200.0), burst is optional """
+    glob, _, limit = spec.rpartition("=")
+    if not glob:
+        raise ValueError("limit format is GLOB=RATE[:BURST]: %s" % spec)
+    rate, _, burst = limit.partition(":")
+    rate = float(rate)
+    return glob, rate, check_burst(float(burst)) if burst else None
+
+
+class FloodControl(object):
+    """
+    Token bucket for every hostname_n, refilled at rate lines per second up to burst lines.
+    Host specific limits are (glob, rate, burst) tuples, the first matching glob is used.
+    A rate of 0 means no limit. The burst defaults to the rate, but is at least 1 line,
+    so rates below 1 line per second still let a line through every 1/rate seconds.
+
+    Bucket state is kept in flat arrays indexed by host, so thousands of hosts are cheap to track.
+    """
+
+    def __init__(self, rate, burst=None, limits=()):
+        self.rate = rate
+        self.burst = max(1.0, burst if burst is not None else rate)
+        self.limits = list(limits)
+        self.index = {}  # hostname_n: position in the arrays
+        self.hosts = []
+        self.rates = array.array("d")
+        self.bursts = array.array("d")
+        self.tokens = array.array("d")
+        self.updated = array.array("d")
+        self.dropped = array.array("L")
+
+    def _add_host(self, hostname_n, t):
+        rate, burst = self.rate, self.burst
+        for glob, r, b in self.limits:
+            if fnmatch.fnmatchcase(hostname_n, glob):
+                rate, burst = r, max(1.0, b if b is not None else r)
+                break
+        i = len(self.hosts)
+        self.index[hostname_n] = i
+        self.hosts.append(hostname_n)
+        self.rates.append(rate)
+        self.bursts.append(burst)
+        self.tokens.append(burst)
+        self.updated.append(t)
+        self.dropped.append(0)
+        return i
+
+    def allow(self, hostname_n, t=None):
+        """ Take a token for the line, returns False if the line should be dropped. """
+        if t is None:
+            t = time.time()
+        i = self.index.get(hostname_n)
+        if i is None:
+            i = self._add_host(hostname_n, t)
+        if self.rates[i] <= 0:
+            return True
+        tokens = min(self.bursts[i], self.tokens[i] + (t - self.updated[i]) * self.rates[i])
+        self.updated[i] = t
+        if tokens >= 1.0:
+            self.tokens[i] = tokens - 1.0
+            return True
+        self.tokens[i] = tokens
+        self.dropped[i] += 1
+        return False
+
+    def suppressed(self):
+        """ List of (hostname_n, dropped lines) since the last call, resets the counters. """
+        out = []
+        for i, n in enumerate(self.dropped):
+            if n:
+                out.append((self.hosts[i], n))
+                self.dropped[i] = 0
+        return out
@@ -0,0 +1,40 @@
+"""hashring.py: consistent hashing of loggers to a pool of servers."""
+
+import bisect
+import hashlib
+
+__license__ = "MIT"
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Every server is placed on the ring replicas times. A key belongs to the first server
+    clockwise from its hash, the following distinct servers are the failover order.
+    Adding or removing a server only moves the keys of that server.
+    """
+
+    def __init__(self, servers, replicas=100):
+        self.servers = []
+        for server in servers:
+            if server not in self.servers:
+                self.servers.append(server)
+        self.ring = sorted((_hash("%s#%d" % (server, i)), server) for server in self.servers for i in range(replicas))
+        self.hashes = [h for h, server in self.ring]
+
+    def preference(self, key):
+        """ List of all servers in the order they should be tried for the key. """
+        if not self.ring:
+            return []
+        start = bisect.bisect(self.hashes, _hash(key))
+        order = []
+        for i in range(len(self.ring)):
+            server = self.ring[(start + i) % len(self.ring)][1]
+            if server not in order:
+                order.append(server)
+                if len(order) == len(self.servers):
+                    break
+        return order
@@ -0,0 +1,192 @@
+"""history.py: in-memory per-host history of recent loglines."""
+
+import time
+import heapq
+import array
+import fnmatch
+import calendar
+
+__license__ = "MIT"
+
+
+# rough per line bookkeeping cost on top of the line itself
+LINE_OVERHEAD = 64
+# memory of a slot in a ring, a list pointer and a double
+SLOT_SIZE = 16
+MIN_SLOTS = 16
+
+
+class HostRing(object):
+    """
+    Ring of (receive time, line) for one hostname_n, holding at most maxlines lines, no limit if None.
+    The slot arrays grow and shrink with the number of lines, nbytes includes their size.
+    """
+
+    def __init__(self, maxlines):
+        self.maxlines = maxlines
+        self.lines = []
+        self.times = array.array("d")
+        self.head = 0  # index of the oldest entry
+        self.count = 0
+        self.nbytes = 0
+        self._resize(MIN_SLOTS if maxlines is None else min(MIN_SLOTS, maxlines))
+
+    def _resize(self, size):
+        """ Move the entries to new slot arrays of the given size, oldest first. """
+        old = len(self.lines)
+        order = [(self.head + k) % old for k in range(self.count)]
+        self.lines = [self.lines[i] for i in order] + [None] * (size - self.count)
+        self.times = array.array("d", [self.times[i] for i in order]) + array.array("d", [0.0]) * (size - self.count)
+        self.head = 0
+        self.nbytes += (size - old) * SLOT_SIZE
+
+    def append(self, t, line):
+        size = len(self.lines)
+        if self.count == size:
+            if self.maxlines is None:
+                self._resize(size * 2)
+                size = len(self.lines)
+            elif size < self.maxlines:
+                self._resize(min(size * 2, self.maxlines))
+                size = len(self.lines)
+            else:
+                self.pop()
+        i = (self.head + self.count) % size
+        self.lines[i] = line
+        self.times[i] = t
+        self.count += 1
+        self.nbytes += len(line) + LINE_OVERHEAD
+
+    def pop(self):
+        """ Drop the oldest entry. """
+        line = self.lines[self.head]
+        self.lines[self.head] = None
+        self.head = (self.head + 1) % len(self.lines)
+        self.count -= 1
+        self.nbytes -= len(line) + LINE_OVERHEAD
+        size = len(self.lines)
+        if size > MIN_SLOTS and self.count < size // 4:
+            self._resize(max(size // 2, MIN_SLOTS))
+
+    def oldest(self):
+        return self.times[self.head]
+
+    def since(self, t):
+        """ List of (receive time, line) received at or after t, oldest first. """
+        size = len(self.lines)
+        out = []
+        for k in range(self.count):
+            i = (self.head + k) % size
+            if self.times[i] >= t:
+                out.append((self.times[i], self.lines[i]))
+        return out
+
+
+class History(object):
+    """
+    Keep the last maxlines lines, but no lines older than maxage seconds, for every hostname_n.
+    Either limit can be None. The total size of all the rings, lines and slots, is kept under
+    maxbytes by dropping the oldest lines of all hosts. Rings that become empty are dropped.
+    """
+
+    def __init__(self, maxlines=1000, maxage=None, maxbytes=64 * 1024 * 1024):
+        self.maxlines = maxlines
+        self.maxage = maxage
+        self.maxbytes = maxbytes
+        self.rings = {}
+        self.nbytes = 0
+
+    def append(self, hostname_n, line, t=None):
+        if t is None:
+            t = time.time()
+        ring = self.rings.get(hostname_n)
+        if ring is None:
+            ring = HostRing(self.maxlines)
+            self.rings[hostname_n] = ring
+            self.nbytes += ring.nbytes
+        before = ring.nbytes
+        ring.append(t, line)
+        self.nbytes += ring.nbytes - before
+        if self.maxbytes and self.nbytes > self.maxbytes:
+            self._trim(self.maxbytes * 9 // 10)
+
+    def expire(self, t=None):
+        """ Drop lines older than maxage, call this periodically. """
+        if not self.maxage:
+            return
+        if t is None:
+            t = time.time()
+        limit = t - self.maxage
+        for hostname_n in list(self.rings):
+            ring = self.rings[hostname_n]
+            before = ring.nbytes
+            while ring.count and ring.oldest() < limit:
+                ring.pop()
+            self.nbytes -= before - ring.nbytes
+            if ring.count == 0:
+                self.nbytes -= ring.nbytes  # the empty slots
+                del self.rings[hostname_n]
+
+    def _trim(self, target):
+        heap = [(ring.oldest(), hostname_n) for hostname_n, ring in self.rings.items() if ring.count]
+        heapq.heapify(heap)
+        while heap and self.nbytes > target:
+            _, hostname_n = heapq.heappop(heap)
+            ring = self.rings[hostname_n]
+            before = ring.nbytes
+            ring.pop()
+            self.nbytes -= before - ring.nbytes
+            if ring.count:
+                heapq.heappush(heap, (ring.oldest(), hostname_n))
+        for hostname_n in [h for h, r in self.rings.items() if r.count == 0]:
+            self.nbytes -= self.rings[hostname_n].nbytes  # the empty slots
+            del self.rings[hostname_n]
+
+    def query(self, since=None, host=None, limit=None):
+        """
+        Lines received at or after since (unix time) from hosts matching the host glob,
+        ordered by receive time. With a limit the newest lines are returned.
+        """
+        if since is None:
+            since = 0.0
+        found = []
+        for hostname_n, ring in self.rings.items():
+            if host is None or fnmatch.fnmatchcase(hostname_n, host):
+                found.extend(ring.since(since))
+        found.sort(key=lambda e: e[0])
+        if limit is not None:
+            found = found[-limit:] if limit > 0 else []
+        return [line for t, line in found]
+
+
+def parse_since(value):
+    """ since is either unix time or a UTC timestr like '2015-01-14T13:41:37.90Z' """
+    try:
+        return float(value)
+    except ValueError:
+        value = value.replace(" ", "T").rstrip("Z")
+        frac = 0.0
+        if "." in value:
+            value, f = value.split(".", 1)
+            frac = float("0." + f)
+        fmt = "%Y-%m-%dT%H:%M:%S"[:len(value) - 2]  # allow partial timestrs like '2015-01-14T13'
+        return calendar.timegm(time.strptime(value, fmt)) + frac
+
+
+def parse_query(query):
+    """
+    Query format: "since=1421242897.9 host=koerkana1_* limit=100", all keys are optional.
+    Returns a dict of keyword arguments for History.query.
+    """
+    args = {}
+    for item in query.split():
+        key, _, value = item.partition("=")
+        if key == "since":
+            args["since"] = parse_since(value)
+        elif key == "host":
+            args["host"] = value
+        elif key == "limit":
+            args["limit"] = int(value)
+        else:
+            raise ValueError("unknown query key %s" % key)
+    return args
@@ -0,0 +1,71 @@
+"""logcache.py: LRU cache of open per-host file loggers."""
+
+import time
+import collections
+
+__license__ = "MIT"
+
+
+class LoggerCache(object):
+    """
+    Keep at most maxopen loggers open, close the least recently used one when a new one is needed.
+    Loggers not used for idle seconds are closed by expire(). Closed loggers are reopened
+    on next use with factory(key), which should append to the existing file.
+    """
+
+    def __init__(self, factory, maxopen=256, idle=None):
+        self.factory = factory
+        self.maxopen = maxopen
+        self.idle = idle
+        self.loggers = collections.OrderedDict()  # key: (logger, last used)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.loggers
+
+    def __len__(self):
+        return len(self.loggers)
+
+    def get(self, key):
+        entry = self.loggers.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            while self.loggers and len(self.loggers) >= self.maxopen:
+                self._close(self.loggers.popitem(last=False)[1][0])
+                self.evictions += 1
+            logger = self.factory(key)
+        else:
+            self.hits += 1
+            logger = entry[0]
+        self.loggers[key] = (logger, time.time())
+        return logger
+
+    def expire(self, t=None):
+        """ Close loggers that have been idle for too long. """
+        if not self.idle:
+            return
+        if t is None:
+            t = time.time()
+        while self.loggers:
+            key, (logger, last) = next(iter(self.loggers.items()))
+            if t - last < self.idle:
+                break
+            del self.loggers[key]
+            self._close(logger)
+            self.evictions += 1
+
+    def close(self):
+        while self.loggers:
+            self._close(self.loggers.popitem(last=False)[1][0])
+
+    def stats(self):
+        return dict(open=len(self.loggers), hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    @staticmethod
+    def _close(logger):
+        for handler in list(logger.handlers):
+            handler.flush()
+            handler.close()
+            logger.removeHandler(handler)
@@ -0,0 +1,373 @@
+#!/usr/bin/env python2
+"""
+Search the log files written by nanoprintf-server for a time range.
+
+The server writes one file per hostname_n, "log_<hostname_n>.log", and rotates
+it every midnight (UTC) into "log_<hostname_n>.log.YYYY-MM-DD". Every line in a
+file has the format:
+    "2015-01-14T13:41:37.900Z 'I| main:12|Hello world'"
+    "x2015-01-14T13:41:37.900Z 'Hello world'"
+
+Rotated files that can not contain lines from the requested time range are
+skipped based on the date in their name. Inside a file the start of the range
+is found by bisecting on the line timestamps in a memory mapped file. The range
+is searched in slices (--slice seconds), the files are scanned in parallel for
+every slice and the matching lines of a slice are written to stdout ordered by
+timestamp while the next slice is scanned, so output starts early and memory use
+is bounded by the matches in one slice:
+    "host1_1 2015-01-14T13:41:37.900Z 'I| main:12|Hello world'"
+Gzipped files can not be seeked, so they are scanned once for the whole range and
+their matches are held until the slices they belong to are written.
+
+The time range is given as (partial) ISO timestamps, --since is inclusive and
+--until is exclusive: --since 2015-01-14T13 --until 2015-01-14T14 selects one
+hour.
+"""
+
+import os
+import re
+import sys
+import gzip
+import mmap
+import heapq
+import bisect
+import fnmatch
+import datetime
+import multiprocessing
+
+import logging
+
+__license__ = "MIT"
+
+
+log = logging.getLogger(__name__)
+
+
+LOGFILE_RE = re.compile(r"^log_(.+)\.log(?:\.(\d{4}-\d{2}-\d{2}))?(\.gz)?$")
+TIMESTAMP_RE = re.compile(br"x?(\d{4}-\d{2}-\d{2}T[0-9:.]+Z)")
+LEVEL_RE = re.compile(r"[\s'\"]([DIWE])\|")
+
+LEVELS = "DIWE"
+
+# lines are timestamped by the logger and may reach the server long after that,
+# so a rotated file can hold lines from before its date
+ROTATION_SLACK = datetime.timedelta(days=1)
+
+SLICE_SECONDS = 3600
+
+# broken lines are timestamped on arrival and may be out of order with the lines around
+# them, so a file is read from this much before the range and until this much after it
+ORDER_SLACK = datetime.timedelta(seconds=60)
+
+
+def parse_log_filename(filename):
+    """
+    "log_host1_1.log"            -> ("host1_1", None)
+    "log_host1_1.log.2015-01-14" -> ("host1_1", datetime.date(2015, 1, 14))
+    Returns None for files that are not nanoprintf-server logs.
+    """
+    m = LOGFILE_RE.match(os.path.basename(filename))
+    if m is None:
+        return None
+    day = None
+    if m.group(2):
+        day = datetime.datetime.strptime(m.group(2), "%Y-%m-%d").date()
+    return m.group(1), day
+
+
+def normalize_timestr(timestr):
+    """ '2015-01-14 13:41' -> '2015-01-14T13:41', comparable with the log timestamps """
+    if timestr is None:
+        return None
+    return timestr.strip().replace(" ", "T").rstrip("Z")
+
+
+def parse_timestr(timestr):
+    """ '2015-01-14T13:41:37.900', also partial like '2015-01-14T13' -> datetime """
+    timestr = normalize_timestr(timestr)
+    frac = 0.0
+    if "." in timestr:
+        timestr, f = timestr.split(".", 1)
+        frac = float("0." + f)
+    fmt = "%Y-%m-%dT%H:%M:%S"[:len(timestr) - 2]  # format length follows the length of the timestr
+    return datetime.datetime.strptime(timestr, fmt) + datetime.timedelta(seconds=frac)
+
+
+def format_timestr(dt):
+    """ datetime -> '2015-01-14T13:41:37.900', comparable with the log timestamps """
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+
+def file_in_range(day, since, until):
+    """ Check if a file rotated on the given day can contain lines in [since, until). """
+    if day is None:  # the current file, can contain anything
+        return True
+    if since is not None and since >= (day + datetime.timedelta(days=1)).isoformat():
+        return False
+    if until is not None and until <= (day - ROTATION_SLACK).isoformat():
+        return False
+    return True
+
+
+def find_logfiles(logdir, hosts=None, since=None, until=None):
+    """
+    Return a list of (path, hostname_n, day) for the log files matching the hosts globs and
+    the time range, day is the rotation date or None for the current file.
+    """
+    found = []
+    for filename in sorted(os.listdir(logdir)):
+        parsed = parse_log_filename(filename)
+        if parsed is None:
+            continue
+        hostname_n, day = parsed
+        if hosts and not any(fnmatch.fnmatchcase(hostname_n, h) for h in hosts):
+            continue
+        if file_in_range(day, since, until):
+            found.append((os.path.join(logdir, filename), hostname_n, day))
+    return found
+
+
+def file_timestamps(path):
+    """ Timestamps of the first and the last line in the file, (None, None) if the file is empty. """
+    first, last = None, None
+    try:
+        if path.endswith(".gz"):
+            with gzip.open(path, "rb") as f:
+                for line in f:
+                    m = TIMESTAMP_RE.match(line)
+                    if m is not None:
+                        first = first or m.group(1)
+                        last = m.group(1)
+        else:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None, None
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    first = _line_timestamp(mm, 0)
+                    last = _line_timestamp(mm, mm.rfind(b"\n", 0, len(mm) - 1) + 1)
+                finally:
+                    mm.close()
+    except (IOError, OSError) as e:
+        log.warning("could not read %s: %s", path, e)
+    return tuple(ts.decode("ascii").rstrip("Z") if ts is not None else None for ts in (first, last))
+
+
+def time_slices(since, until, start, end, seconds):
+    """
+    Split [since, until) into slices of the given length, boundaries stepping from start to end.
+    The first slice starts at since and the last one ends at until, either may be None (open).
+    """
+    bounds = [since]
+    t = parse_timestr(start) + datetime.timedelta(seconds=seconds)
+    end = parse_timestr(end)
+    while t < end:
+        bounds.append(format_timestr(t))
+        t += datetime.timedelta(seconds=seconds)
+    bounds.append(until)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _line_start(mm, pos):
+    """ Offset of the first line that starts at or after pos. """
+    if pos <= 0:
+        return 0
+    i = mm.find(b"\n", pos - 1)
+    if i == -1:
+        return len(mm)
+    return i + 1
+
+
+def _line_timestamp(mm, start):
+    """ Timestamp of the line starting at the given offset, None at the end of the file. """
+    end = mm.find(b"\n", start)
+    if end == -1:
+        end = len(mm)
+    if start >= end:
+        return None
+    m = TIMESTAMP_RE.match(mm[start:end])
+    if m is None:
+        return None
+    return m.group(1)
+
+
+def bisect_logfile(mm, since):
+    """ Offset of the first line in the memory mapped file with a timestamp >= since. """
+    lo, hi = 0, len(mm)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        ts = _line_timestamp(mm, _line_start(mm, mid))
+        if ts is not None and ts < since:
+            lo = mid + 1
+        else:
+            hi = mid
+    return _line_start(mm, lo)
+
+
+def _filter_lines(lines, hostname_n, since, until, stop, levels, pattern):
+    """ Matching lines in [since, until), reading ends at the first line at or after stop. """
+    found = []
+    for line in lines:
+        line = line.rstrip(b"\r\n")
+        m = TIMESTAMP_RE.match(line)
+        if m is None:
+            continue
+        ts = m.group(1)
+        if since is not None and ts < since:
+            continue
+        if stop is not None and ts >= stop:
+            break
+        if until is not None and ts >= until:
+            continue
+        line = line.decode("utf-8", "replace")
+        if levels is not None:
+            lvl = LEVEL_RE.search(line)
+            if lvl is None or lvl.group(1) not in levels:
+                continue
+        if pattern is not None and pattern.search(line) is None:
+            continue
+        found.append((ts.decode("ascii"), hostname_n, line))
+    return found
+
+
+def scan_logfile(path, hostname_n, since=None, until=None, levels=None, pattern=None):
+    """
+    Return a sorted list of (timestamp, hostname_n, line) for the lines in the file that
+    fall in the time range, have one of the levels and match the regex pattern.
+    """
+    seek = format_timestr(parse_timestr(since) - ORDER_SLACK).encode("ascii") if since is not None else None
+    stop = format_timestr(parse_timestr(until) + ORDER_SLACK).encode("ascii") if until is not None else None
+    since = since.encode("ascii") if since is not None else None
+    until = until.encode("ascii") if until is not None else None
+    pattern = re.compile(pattern) if pattern is not None else None
+
+    try:
+        if path.endswith(".gz"):  # compressed by an external tool, can only be read through
+            with gzip.open(path, "rb") as f:
+                found = _filter_lines(f, hostname_n, since, until, stop, levels, pattern)
+        else:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return []
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    if seek is not None:
+                        mm.seek(bisect_logfile(mm, seek))
+                    found = _filter_lines(iter(mm.readline, b""), hostname_n, since, until, stop, levels, pattern)
+                finally:
+                    mm.close()
+    except (IOError, OSError) as e:
+        log.warning("could not read %s: %s", path, e)
+        return []
+
+    found.sort()  # broken lines may be out of order
+    return found
+
+
+def _scan_logfile(args):
+    return scan_logfile(*args)
+
+
+def _take_until(found, until):
+    """ Remove and return the entries of the sorted list that are before until, all if None. """
+    i = len(found) if until is None else bisect.bisect_left(found, (until,))
+    taken = found[:i]
+    del found[:i]
+    return taken
+
+
+def search(logdir, hosts=None, since=None, until=None, level=None, pattern=None, jobs=None,
+           slice_seconds=SLICE_SECONDS):
+    """
+    Generator of (timestamp, hostname_n, line) for all matching lines in the log directory,
+    ordered by timestamp. The time range is searched slice by slice, the files of a slice are
+    scanned in a pool of worker processes while the results of the previous slice are yielded.
+    Gzipped files are scanned once for the whole range, along with the first slice.
+    """
+    since = normalize_timestr(since)
+    until = normalize_timestr(until)
+    levels = LEVELS[LEVELS.index(level):] if level else None
+
+    logfiles = find_logfiles(logdir, hosts, since, until)
+    log.debug("found %d files", len(logfiles))
+    if not logfiles:
+        return
+
+    start, end = since, until
+    if start is None or end is None:
+        bounds = [file_timestamps(path) for path, hostname_n, day in logfiles]
+        firsts = [first for first, last in bounds if first is not None]
+        lasts = [last for first, last in bounds if last is not None]
+        if not firsts:
+            return
+        start = start or min(firsts)
+        end = end or max(lasts)
+    slices = time_slices(since, until, start, end, slice_seconds)
+    log.debug("searching %d slices", len(slices))
+
+    gz_tasks = [(path, hostname_n, since, until, levels, pattern)
+                for path, hostname_n, day in logfiles if path.endswith(".gz")]
+
+    def tasks(s, u):
+        return [(path, hostname_n, s, u, levels, pattern)
+                for path, hostname_n, day in logfiles if not path.endswith(".gz") and file_in_range(day, s, u)]
+
+    if jobs == 1:
+        gz_results = [_scan_logfile(task) for task in gz_tasks]
+        for s, u in slices:
+            results = [_scan_logfile(task) for task in tasks(s, u)]
+            for entry in heapq.merge(*results + [_take_until(found, u) for found in gz_results]):
+                yield entry
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        gz_pending = pool.map_async(_scan_logfile, gz_tasks)
+        pending = pool.map_async(_scan_logfile, tasks(*slices[0]))
+        gz_results = gz_pending.get()
+        for i in range(len(slices)):
+            results = pending.get()
+            if i + 1 < len(slices):  # scan the next slice while this one is written out
+                pending = pool.map_async(_scan_logfile, tasks(*slices[i + 1]))
+            u = slices[i][1]
+            for entry in heapq.merge(*results + [_take_until(found, u) for found in gz_results]):
+                yield entry
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description="Search nanoprintf-server log files by time range, level and regex")
+    ap.add_argument("pattern", nargs="?", default=None, help="regular expression to search for")
+    ap.add_argument("--dir", dest="logdir", default=".", help="directory with the log files, default: .")
+    ap.add_argument("--host", dest="hosts", action="append", default=None,
+                    help="hostname_n glob, for example koerkana1_*, can be repeated")
+    ap.add_argument("--since", default=None, help="start of the time range (inclusive), for example 2015-01-14T13:00")
+    ap.add_argument("--until", default=None, help="end of the time range (exclusive), for example 2015-01-14T14:00")
+    ap.add_argument("--level", default=None, choices=list(LEVELS), help="minimum log level")
+    ap.add_argument("--jobs", default=None, type=int, help="number of parallel workers, default: number of CPUs")
+    ap.add_argument("--slice", dest="slice_seconds", default=SLICE_SECONDS, type=float,
+                    help="search the time range in slices of this many seconds, default: %d" % SLICE_SECONDS)
+    ap.add_argument("--debug", default=False, action="store_true")
+    args = ap.parse_args()
+    if args.slice_seconds <= 0:
+        ap.error("--slice must be a positive number of seconds")
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING,
+                        format="%(asctime)s %(name)s %(levelname)-5s: %(message)s")
+
+    try:
+        for ts, hostname_n, line in search(args.logdir, args.hosts, args.since, args.until,
+                                           args.level, args.pattern, args.jobs, args.slice_seconds):
+            sys.stdout.write("%s %s\n" % (hostname_n, line))
+    except KeyboardInterrupt:
+        pass
+    except IOError:  # stdout closed, for example piped to head
+        pass
+
+
+if __name__ == "__main__":
+    main()
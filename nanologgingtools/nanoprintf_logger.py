@@ -12,6 +12,16 @@ the first element is a millisecond timestamp and looks for a BOOT marker in the
 "([0-9a-f]*) B\|BOOT". It then corrects timestamps using the boot time and millisecond
 timestamp. Lines are marked broken when they correspond to the timestamp format and
 boot time is not known. This behaviour can be disabled with the no-mts option.
+
+Several servers can be given as a comma separated list. The logger sends to the server
+picked by consistent hashing of hostname_portname and fails over to the next server on
+the ring when an ack is not received in time. Unacked lines are sent again to the new server.
+With the failback option the logger returns to the first server that many seconds after
+failing over, but only once a TCP connection to it succeeds, so a server that is still down
+does not hold up the lines for another ack timeout.
+
+Optionally lines below a minimum level (by the [DIWE]| marker) are dropped and consecutive
+identical lines are collapsed into the first line and a "repeated N times (first..last)" line.
 """
 
 import os
@@ -20,6 +30,8 @@ import sys
 import time
 import datetime
 import errno
+import select
+import socket
 
 import serial
 
@@ -28,6 +40,9 @@ from nanomsg import Socket, SOL_SOCKET, RECONNECT_IVL, RECONNECT_IVL_MAX, DONTWA
 
 import logging
 
+from .profiling import PhaseTimer, install as install_profiling
+from .hashring import HashRing
+
 __author__ = "Elmo Trolla, Mattis Marjak, Andres Vahter, Raido Pahtma"
 __license__ = "MIT"
 
@@ -38,6 +53,12 @@ log = logging.getLogger(__name__)
 # drop messages that are in buf but older than this.
 MAX_MSG_AGE = 30 * 60.0
 MAX_ACK_TIMEOUT = 60.0
+# give up on a failback connection attempt after this long
+PROBE_TIMEOUT = 5.0
+
+LEVELS = "DIWE"
+# "1a2b D|..." with the millisecond timestamp, or "D|..." without
+LEVEL_RE = re.compile(r"^(?:[0-9a-f]+ )?([DIWE])\|")
 
 
 def log_timestr(t=None):
@@ -82,6 +103,117 @@ class NewlineParser:
             return t
 
 
+class EdgeReducer(object):
+    """
+    Drop lines below min_level and collapse runs of identical lines before they are sent.
+    The first line of a run is passed on, the repeats are counted and replaced by one
+    "<level>| repeat:0|repeated N times (first..last)" line when the run ends, when window seconds
+    have passed since the first repeat or when max_repeats is reached. The level is the one of
+    the repeated line, I for lines without a level marker. Lines are compared without the
+    millisecond timestamp.
+    """
+
+    def __init__(self, min_level=None, collapse=False, window=10.0, max_repeats=10000):
+        self.min_level = LEVELS.index(min_level) if min_level else None
+        self.collapse = collapse
+        self.window = window
+        self.max_repeats = max_repeats
+        self.last_key = None
+        self.level = None
+        self.repeats = 0
+        self.t_first = None
+        self.t_last = None
+
+    def put(self, ts, line, broken=False):
+        """ Returns a list of (timestamp, line, broken) to send. """
+        m = LEVEL_RE.match(line)
+        if m is not None and self.min_level is not None and LEVELS.index(m.group(1)) < self.min_level:
+            return []
+
+        if not self.collapse:
+            return [(ts, line, broken)]
+
+        key = line[m.start(1):] if m is not None else line
+        if key == self.last_key:
+            if self.repeats == 0:
+                self.t_first = ts
+            self.repeats += 1
+            self.t_last = ts
+            if self.repeats >= self.max_repeats:
+                return self._summary()
+            return []
+
+        out = self._summary()
+        self.last_key = key
+        self.level = m.group(1) if m is not None else "I"
+        out.append((ts, line, broken))
+        return out
+
+    def flush(self, t):
+        """ Returns the summary of a run that has been held for longer than the window. """
+        if self.repeats and t - self.t_first >= self.window:
+            return self._summary()
+        return []
+
+    def end_run(self):
+        """ Returns the summary of the pending run and starts over, for when the input was lost. """
+        out = self._summary()
+        self.last_key = None
+        return out
+
+    def _summary(self):
+        if not self.repeats:
+            return []
+        line = "%s| repeat:0|repeated %d times (%s..%s)" % (self.level, self.repeats,
+                                                            log_timestr(self.t_first), log_timestr(self.t_last))
+        self.repeats = 0
+        return [(self.t_last, line, False)]
+
+
+class ServerProbe(object):
+    """
+    Non-blocking TCP connect to the host and port of a nanomsg tcp:// endpoint, to find out if
+    a server is reachable without stalling the serial port. Other transports can not be probed
+    and are reported reachable.
+    """
+
+    def __init__(self, server, timeout=PROBE_TIMEOUT):
+        self.t_start = time.time()
+        self.timeout = timeout
+        self.sock = None
+        self.result = None
+        if not server.startswith("tcp://"):
+            self.result = True
+            return
+        try:
+            host, _, port = server[len("tcp://"):].split(";")[-1].rpartition(":")
+            family, socktype, proto, _, addr = socket.getaddrinfo(host.strip("[]"), int(port),
+                                                                  0, socket.SOCK_STREAM)[0]
+            self.sock = socket.socket(family, socktype, proto)
+            self.sock.setblocking(0)
+            if self.sock.connect_ex(addr) not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self.result = False
+        except (socket.error, ValueError):
+            self.result = False
+
+    def poll(self):
+        """ True if the server accepted the connection, False if not, None while connecting. """
+        if self.result is None:
+            _, writable, _ = select.select([], [self.sock], [], 0)
+            if writable:
+                self.result = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+            elif time.time() - self.t_start > self.timeout:
+                self.result = False
+        if self.result is not None:
+            self.close()
+        return self.result
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
 def connect(server):
     soc = Socket(REQ)
     # start reconnecting after one second pause
@@ -95,20 +227,37 @@ def connect(server):
     return soc
 
 
-def run(server, port="/dev/ttyUSB0", baud=115200, portname=None, mts=True, debug=False):
+def run(server, port="/dev/ttyUSB0", baud=115200, portname=None, mts=True, debug=False, timer=None,
+        min_level=None, collapse=False, collapse_window=10.0, failback=0.0):
     """
     Read data from serial port, split by newlines,
     prepend hostname and timestr to every line and
     send to a nanomsg REP socket.
     """
-    log.info("using port %s @ %s, sending to server %s", port, baud, server)
+    if timer is None:
+        timer = PhaseTimer()
+
+    if portname is None:
+        portname = port[-1]
+
+    if not isinstance(server, (list, tuple)):
+        server = server.split(",")
+    server = [s.strip() for s in server if s.strip()]
+    servers = HashRing(server).preference("%s_%s" % (os.uname()[1], portname))
+    server_index = 0
+    t_failover = None
+    probe = None
+
+    log.info("using port %s @ %s, sending to server %s", port, baud, servers[0])
+    if len(servers) > 1:
+        log.info("failover servers %s", ", ".join(servers[1:]))
 
     # setup nanomsg
-    soc = connect(server)
+    soc = connect(servers[server_index])
     soc_waiting_for_ack = None
 
-    if portname is None:
-        portname = port[-1]
+    # kept over serial port reconnects, so a run of repeats is not lost with the port
+    reducer = EdgeReducer(min_level, collapse, collapse_window)
 
     while True:
         try:
@@ -146,9 +295,16 @@ def run(server, port="/dev/ttyUSB0", baud=115200, portname=None, mts=True, debug
             seqno = 0
             bts = None  # BootTimeStamp
 
+            # repeats collapsed before the port was lost
+            for ts, l, broken in reducer.end_run():
+                outbuf.append((ts, prepare_tx_line(portname, seqno, l, ts, broken=broken)))
+                seqno += 1
+
             while True:
+                tp = timer.start()
                 s = serialport.read(1000)
                 t = time.time()
+                tp = timer.lap("read", tp)
                 if s:
                     t_last_recv = t
                     parser.put(s)
@@ -183,8 +339,15 @@ def run(server, port="/dev/ttyUSB0", baud=115200, portname=None, mts=True, debug
                                     log.debug("%s/%s (%s, %.3f): %s", log_timestr(t), log_timestr(ts),
                                               log_timestr(bts), offs, l)
 
-                        outbuf.append((ts, prepare_tx_line(portname, seqno, l, ts, broken=broken)))
-                        seqno += 1
+                        for ts, l, broken in reducer.put(ts, l, broken):
+                            outbuf.append((ts, prepare_tx_line(portname, seqno, l, ts, broken=broken)))
+                            seqno += 1
+
+                for ts, l, broken in reducer.flush(t):
+                    outbuf.append((ts, prepare_tx_line(portname, seqno, l, ts, broken=broken)))
+                    seqno += 1
+
+                tp = timer.lap("parse", tp)
 
                 # # this here is for testing the system if there's no serial port traffic
                 # if t - t_last_recv > 0.5:
@@ -195,8 +358,9 @@ def run(server, port="/dev/ttyUSB0", baud=115200, portname=None, mts=True, debug
                 # if no newline character arrives after 0.2s of last recv and parser.buf
                 # contains data, send out the partial line.
                 if t - t_last_recv > 0.2 and parser.buf:
-                    outbuf.append((t, prepare_tx_line(portname, seqno, parser.buf, t, broken=True)))
-                    seqno += 1
+                    for ts, l, broken in reducer.put(t, parser.buf, True):
+                        outbuf.append((ts, prepare_tx_line(portname, seqno, l, ts, broken=broken)))
+                        seqno += 1
                     parser.buf = ""
 
                 # clean up the outbuf. remove entries older than 30 minutes.
@@ -211,11 +375,18 @@ def run(server, port="/dev/ttyUSB0", baud=115200, portname=None, mts=True, debug
 
                 if soc_waiting_for_ack is not None:
                     if time.time() - soc_waiting_for_ack > MAX_ACK_TIMEOUT:
-                        log.warning("No ack for %d ... reconnecting. (queue %d)", MAX_ACK_TIMEOUT, len(outbuf))
+                        # unacked messages stay in outbuf and are sent again to the next server
+                        server_index = (server_index + 1) % len(servers)
+                        log.warning("No ack for %d ... reconnecting to %s. (queue %d)",
+                                    MAX_ACK_TIMEOUT, servers[server_index], len(outbuf))
                         soc_waiting_for_ack = None
+                        t_failover = time.time()
+                        if probe is not None:
+                            probe.close()
+                            probe = None
 
                         soc.close()
-                        soc = connect(server)
+                        soc = connect(servers[server_index])
                     else:
                         try:
                             if soc.recv(flags=DONTWAIT):
@@ -229,6 +400,25 @@ def run(server, port="/dev/ttyUSB0", baud=115200, portname=None, mts=True, debug
                                 # unknown error!
                                 raise
 
+                # return to the first server when it accepts connections again
+                if failback and soc_waiting_for_ack is None and server_index != 0:
+                    if probe is None:
+                        if time.time() - t_failover > failback:
+                            probe = ServerProbe(servers[0])
+                    else:
+                        reachable = probe.poll()
+                        if reachable is not None:
+                            probe = None
+                            if reachable:
+                                server_index = 0
+                                log.info("Failing back to %s. (queue %d)", servers[server_index], len(outbuf))
+
+                                soc.close()
+                                soc = connect(servers[server_index])
+                            else:
+                                log.debug("%s still unreachable", servers[0])
+                                t_failover = time.time()
+
                 if soc_waiting_for_ack is None and outbuf:
                     txmsg = "\n".join([e[1] for e in outbuf])  # join all messages to one big.
                     outbuf_tx_index = len(outbuf)
@@ -236,6 +426,8 @@ def run(server, port="/dev/ttyUSB0", baud=115200, portname=None, mts=True, debug
                     soc.send(txmsg)
                     soc_waiting_for_ack = time.time()
 
+                timer.lap("send", tp)
+
                 time.sleep(.01)
         except serial.SerialException as e:
             log.warning("Serial port disconnected: %s. Will try to open again." % (e.message))
@@ -244,12 +436,24 @@ def run(server, port="/dev/ttyUSB0", baud=115200, portname=None, mts=True, debug
 def main():
     from argparse import ArgumentParser
     ap = ArgumentParser(description="Printf UART logger that logs to nanomsg")
-    ap.add_argument("server", help="nanomsg printf server, for example tcp://logserver.local:14999")
+    ap.add_argument("server", help="nanomsg printf server, for example tcp://logserver.local:14999, "
+                                   "or a comma separated list of servers to shard and fail over between")
     ap.add_argument("port", help="Serial port")
     ap.add_argument("baud", default=115200, help="Serial port baudrate")
     ap.add_argument("--portname", default=None)
     ap.add_argument("--no-mts", default=False, action="store_true")
+    ap.add_argument("--min-level", default=None, choices=list(LEVELS),
+                    help="drop lines with a lower level marker, lines without a marker are kept")
+    ap.add_argument("--collapse-repeats", default=False, action="store_true",
+                    help="send consecutive identical lines once with a 'repeated N times' line")
+    ap.add_argument("--collapse-window", default=10.0, type=float,
+                    help="max seconds to hold back repeated lines, default: 10")
+    ap.add_argument("--failback", default=0.0, type=float,
+                    help="seconds after failing over to return to the first server once it is reachable, "
+                         "default: 0 (stay on the failover server)")
     ap.add_argument("--debug", default=False, action="store_true")
+    ap.add_argument("--profile", default=None,
+                    help="profile from start, write pstats to this file on exit or SIGUSR1")
     args = ap.parse_args()
 
     if args.debug:
@@ -258,7 +462,9 @@ def main():
         loglevel = logging.INFO
 
     logging.basicConfig(level=loglevel, format="%(asctime)s %(name)s %(levelname)-5s: %(message)s")
-    run(args.server, args.port, args.baud, args.portname, not args.no_mts, args.debug)
+    timer = install_profiling(args.profile)
+    run(args.server, args.port, args.baud, args.portname, not args.no_mts, args.debug, timer,
+        args.min_level, args.collapse_repeats, args.collapse_window, args.failback)
 
 
 if __name__ == "__main__":
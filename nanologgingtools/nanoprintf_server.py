@@ -20,6 +20,11 @@ from nanomsg import SOL_SOCKET, RECONNECT_IVL, RECONNECT_IVL_MAX, DONTWAIT, Nano
 import logging
 import logging.handlers
 from .watchedlogger import WatchedTimedRotatingFileHandler
+from .history import History, parse_query
+from .logcache import LoggerCache
+from .reorder import ReorderBuffer
+from .profiling import PhaseTimer, install as install_profiling
+from .floodcontrol import FloodControl, parse_limit, check_burst
 
 __author__ = "Elmo Trolla, Mattis Marjak, Andres Vahter, Raido Pahtma"
 __license__ = "MIT"
@@ -30,8 +35,10 @@ logging.basicConfig(
     format="%(asctime)s %(name)s %(levelname)-5s: %(message)s"
 )
 
-# dict of opened loggers. one for every device/logfile
-g_loggers = {}
+# cache of opened loggers. one for every device/logfile, replaced in run()
+g_loggers = LoggerCache(lambda hostname_n: create_logger("log_%s.log" % hostname_n))
+# hosts that have had a log file opened, reopening after eviction is not announced
+g_seen_hosts = set()
 
 
 def create_logger(filename):
@@ -45,7 +52,10 @@ def create_logger(filename):
         backupCount=14
     )
     logfile.setFormatter(logformat)
-    newlogger = logging.getLogger(filename)
+    # not registered with logging.getLogger, so that closed loggers can be garbage collected,
+    # but still propagating to the root logger for --debug output
+    newlogger = logging.Logger(filename)
+    newlogger.parent = logging.getLogger()
     newlogger.addHandler(logfile)
     newlogger.setLevel(logging.DEBUG)
     return newlogger
@@ -62,22 +72,49 @@ def write_to_log(msg):
 
     # create one logger for every hostname_n (unique for each host and serial port)
     # the logger will create one rotated log file for itself.
+    # least recently used loggers are closed and reopened when needed again.
     if hostname_n not in g_loggers:
-        logfilename = "log_%s.log" % hostname_n
-        g_loggers[hostname_n] = create_logger(logfilename)
-        sys.stdout.write("\n")
-        log.info("opening log file %s", logfilename)
+        if hostname_n in g_seen_hosts:
+            log.debug("reopening log file log_%s.log", hostname_n)
+        else:
+            g_seen_hosts.add(hostname_n)
+            sys.stdout.write("\n")
+            log.info("opening log file log_%s.log", hostname_n)
 
-    g_loggers[hostname_n].debug(rest)
+    g_loggers.get(hostname_n).debug(rest)
 
 
-def run(addr_listenprintf, addr_forward, addr_subscribe, uselog, debug):
+def suppressed_line(hostname_n, count, t=None):
+    """ A line in place of the ones dropped by flood control, in the same format as the lines from the logger. """
+    if t is None:
+        t = time.time()
+    timestr = datetime.datetime.utcfromtimestamp(t).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+    text = "W| floodcontrol:0|suppressed %d lines from %s" % (count, hostname_n)
+    return "%s %06X %s %s" % (hostname_n, 0, timestr, repr(text))
+
+
+def run(addr_listenprintf, addr_forward, addr_subscribe, uselog, debug,
+        addr_query=None, history_lines=0, history_age=None, history_memory=64,
+        max_open_logs=256, log_idle=300.0, reorder_window=0.0,
+        flood_rate=0.0, flood_burst=None, flood_limits=None, flood_summary=10.0, timer=None):
+    global g_loggers
+
+    if timer is None:
+        timer = PhaseTimer()
+
+    if isinstance(addr_subscribe, str):
+        addr_subscribe = [addr_subscribe]
+    addr_subscribe = [a for a in addr_subscribe or [] if a.lower() != "none"]
 
     log.info("listening for printf-uart-nanomsg: %s", addr_listenprintf)
-    log.info("subscribing for messages to      : %s", addr_subscribe)
+    log.info("subscribing for messages to      : %s", ", ".join(addr_subscribe) or None)
+    log.info("reordering subscribed messages   : %s s", reorder_window)
     log.info("forwarding messages to           : %s", addr_forward)
     log.info("logging messages to files        : %s", uselog)
     log.info("logging messages to stdout       : %s", debug)
+    log.info("serving history queries          : %s", addr_query)
+    log.info("max open log files               : %s", max_open_logs)
+    log.info("flood control lines/s per host   : %s", flood_rate or None)
 
     if not debug:
         logging.getLogger().handlers[0].setLevel(logging.INFO)
@@ -85,6 +122,27 @@ def run(addr_listenprintf, addr_forward, addr_subscribe, uselog, debug):
     soc_rep = None
     soc_pub = None
     soc_sub = None
+    soc_query = None
+
+    g_loggers = LoggerCache(g_loggers.factory, max_open_logs, log_idle)
+    t_logstats = time.time()
+
+    reorder = None
+    if reorder_window > 0:
+        reorder = ReorderBuffer(reorder_window)
+
+    flood = None
+    t_flood = time.time()
+    if flood_rate > 0 or flood_limits:
+        flood = FloodControl(flood_rate, flood_burst,
+                             [parse_limit(spec) for spec in flood_limits or []])
+
+    history = None
+    t_expire = time.time()
+    if history_lines > 0 or history_age:
+        history = History(history_lines or None, history_age, history_memory * 1024 * 1024)
+        log.info("keeping history of %s lines per host, max age %s, max %d MB",
+                 history_lines or None, history_age, history_memory)
 
     if addr_listenprintf and addr_listenprintf.lower() != "none":
         soc_rep = Socket(REP)
@@ -94,67 +152,165 @@ def run(addr_listenprintf, addr_forward, addr_subscribe, uselog, debug):
         soc_pub = Socket(PUB)
         soc_pub.bind(addr_forward)
 
-    if addr_subscribe and addr_subscribe.lower() != "none":
+    if addr_subscribe:
         soc_sub = Socket(SUB)
         soc_sub.set_string_option(SUB, SUB_SUBSCRIBE, "")
         # start reconnecting after one second pause
         # max reconnect timer to 30 seconds
         soc_sub.set_int_option(SOL_SOCKET, RECONNECT_IVL, 1000)
         soc_sub.set_int_option(SOL_SOCKET, RECONNECT_IVL_MAX, 1000 * 30)
-        soc_sub.connect(addr_subscribe)
-
-    while 1:
-        # read from addr_listenprintf and forward to addr_forward
-
-        if soc_rep:
-
-            jumbomsg = None
-            try:
-                jumbomsg = soc_rep.recv(flags=DONTWAIT)
-                jumbomsg = jumbomsg.decode('utf-8')
-            except NanoMsgAPIError as e:
-                if e.errno != errno.EAGAIN:
-                    raise
-
-            if jumbomsg:
-                # reply anything to the REQ socket or no more messages will arrive
-                soc_rep.send("got it")
-                # ONLY messages from the REQ socket can be jumbomessages (simple lines joined by newlines)
-                msgs = jumbomsg.split("\n")
-                hostname_n = "?"
-                for msg in msgs:
-                    hostname_n, rest = msg.split(None, 1)
-                    if soc_pub:
-                        soc_pub.send(msg)
-                    if uselog:
-                        write_to_log(msg)
+        # messages from all the upstream servers are fair-queued on the one socket
+        for addr in addr_subscribe:
+            soc_sub.connect(addr)
+
+    if addr_query and addr_query.lower() != "none":
+        if history is None:
+            log.warning("history queries enabled, but history is not kept, see --history and --history-age")
+        soc_query = Socket(REP)
+        soc_query.bind(addr_query)
 
-                t = datetime.datetime.utcfromtimestamp(time.time()).strftime("%Y-%m-%dT%H:%M:%S.%f")[:22] + "Z"
-                sys.stdout.write("{} {}: {}\n".format(t, hostname_n, len(msgs)))
-                sys.stdout.flush()
+    try:
+        while 1:
+            # read from addr_listenprintf and forward to addr_forward
 
-        # read from addr_subscribe and forward to addr_forward
+            if soc_rep:
 
-        if soc_sub:
-            while 1:
+                jumbomsg = None
+                tp = timer.start()
                 try:
-                    msg = soc_sub.recv(flags=DONTWAIT)
+                    jumbomsg = soc_rep.recv(flags=DONTWAIT)
+                    jumbomsg = jumbomsg.decode('utf-8')
                 except NanoMsgAPIError as e:
-                    if e.errno == errno.EAGAIN:
-                        break
-                    else:
+                    if e.errno != errno.EAGAIN:
                         raise
+                tp = timer.lap("read", tp)
+
+                if jumbomsg:
+                    # reply anything to the REQ socket or no more messages will arrive
+                    soc_rep.send("got it")
+                    # ONLY messages from the REQ socket can be jumbomessages (simple lines joined by newlines)
+                    msgs = jumbomsg.split("\n")
+                    hostname_n = "?"
+                    for msg in msgs:
+                        hostname_n, rest = msg.split(None, 1)
+                        tp = timer.lap("parse", tp)
+                        if flood is not None and not flood.allow(hostname_n):
+                            continue
+                        if soc_pub:
+                            soc_pub.send(msg)
+                            tp = timer.lap("publish", tp)
+                        if uselog:
+                            write_to_log(msg)
+                            tp = timer.lap("write", tp)
+                        if history is not None:
+                            history.append(hostname_n, msg)
+                            tp = timer.lap("history", tp)
+
+                    t = datetime.datetime.utcfromtimestamp(time.time()).strftime("%Y-%m-%dT%H:%M:%S.%f")[:22] + "Z"
+                    sys.stdout.write("{} {}: {}\n".format(t, hostname_n, len(msgs)))
+                    sys.stdout.flush()
 
-                if msg:
+            # read from addr_subscribe and forward to addr_forward
+
+            if soc_sub:
+                received = []
+                tp = timer.start()
+                while 1:
+                    try:
+                        msg = soc_sub.recv(flags=DONTWAIT)
+                    except NanoMsgAPIError as e:
+                        if e.errno == errno.EAGAIN:
+                            break
+                        else:
+                            raise
+
+                    if msg:
+                        received.append(msg.decode('utf-8'))
+
+                # hold messages for the reorder window to merge the upstreams in timestamp order
+                if reorder is not None:
+                    for msg in received:
+                        reorder.put(msg)
+                    received = reorder.pop_ready()
+                tp = timer.lap("subscribe", tp)
+
+                for msg in received:
                     hostname_n, rest = msg.split(None, 1)
                     sys.stdout.write(hostname_n[-1])
                     sys.stdout.flush()
+                    tp = timer.lap("parse", tp)
+                    if flood is not None and not flood.allow(hostname_n):
+                        continue
                     if soc_pub:
                         soc_pub.send(msg)
+                        tp = timer.lap("publish", tp)
                     if uselog:
                         write_to_log(msg)
+                        tp = timer.lap("write", tp)
+                    if history is not None:
+                        history.append(hostname_n, msg)
+                        tp = timer.lap("history", tp)
 
-        time.sleep(0.01)
+            # answer history queries, reply with matching lines joined by newlines
+
+            if soc_query:
+                query = None
+                try:
+                    query = soc_query.recv(flags=DONTWAIT)
+                except NanoMsgAPIError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+
+                if query is not None:
+                    tp = timer.start()
+                    try:
+                        # UnicodeDecodeError is a ValueError, undecodable queries get the empty reply too
+                        lines = history.query(**parse_query(query.decode("utf-8"))) if history is not None else []
+                        soc_query.send("\n".join(lines))
+                    except ValueError as e:
+                        log.warning("bad history query %r: %s", query, e)
+                        soc_query.send("")
+                    timer.lap("query", tp)
+
+            # write a summary line in place of the lines dropped by flood control
+
+            if flood is not None and time.time() - t_flood > flood_summary:
+                t_flood = time.time()
+                for hostname_n, count in flood.suppressed():
+                    log.warning("suppressed %d lines from %s", count, hostname_n)
+                    msg = suppressed_line(hostname_n, count, t_flood)
+                    if soc_pub:
+                        soc_pub.send(msg)
+                    if uselog:
+                        write_to_log(msg)
+                    if history is not None:
+                        history.append(hostname_n, msg)
+
+            if history is not None and time.time() - t_expire > 1.0:
+                t_expire = time.time()
+                history.expire(t_expire)
+
+            if uselog and time.time() - t_logstats > 60.0:
+                t_logstats = time.time()
+                g_loggers.expire(t_logstats)
+                log.info("log files: %(open)d open, %(hits)d hits, %(misses)d misses, %(evictions)d evictions",
+                         g_loggers.stats())
+
+            time.sleep(0.01)
+    finally:
+        # release the lines still held for reordering and close the log files
+        if reorder is not None:
+            for msg in reorder.drain():
+                hostname_n, rest = msg.split(None, 1)
+                if flood is not None and not flood.allow(hostname_n):
+                    continue
+                if soc_pub:
+                    soc_pub.send(msg)
+                if uselog:
+                    write_to_log(msg)
+                if history is not None:
+                    history.append(hostname_n, msg)
+        g_loggers.close()
 
 
 def main():
@@ -183,12 +339,54 @@ def main():
     ap.add_argument(
         "--subscribe",
         dest="addr_subscribe",
+        action="append",
         default=None,
         help=(
             "pull messages from another nanoprintf-server. "
-            "disabled by default, enable with: tcp://host:14998"
+            "disabled by default, enable with: tcp://host:14998. "
+            "can be repeated to pull from several servers"
         )
     )
+    ap.add_argument(
+        "--reorder-window",
+        dest="reorder_window",
+        type=float,
+        default=0.0,
+        help=(
+            "hold subscribed messages for up to this many seconds to merge "
+            "them in timestamp order. default: 0 (off)"
+        )
+    )
+    ap.add_argument(
+        "--query",
+        dest="addr_query",
+        default=None,
+        help=(
+            "serve history queries on a REP socket, for example tcp://*:14997. "
+            "query format: 'since=<unixtime|timestr> host=<glob> limit=<n>'"
+        )
+    )
+    ap.add_argument(
+        "--history",
+        dest="history_lines",
+        type=int,
+        default=0,
+        help="keep this many recent lines per host in memory, default: 0 (no line limit, off without --history-age)"
+    )
+    ap.add_argument(
+        "--history-age",
+        dest="history_age",
+        type=float,
+        default=None,
+        help="drop lines older than this many seconds from history, keeps history without --history"
+    )
+    ap.add_argument(
+        "--history-memory",
+        dest="history_memory",
+        type=int,
+        default=64,
+        help="memory limit for the history of all hosts in MB, default: 64"
+    )
     ap.add_argument(
         "--log",
         dest="uselog",
@@ -201,6 +399,51 @@ def main():
         action="store_true",
         help="write incoming messages to log files"
     )
+    ap.add_argument(
+        "--max-open-logs",
+        dest="max_open_logs",
+        type=int,
+        default=256,
+        help="max number of log files kept open, least recently used are closed. default: 256"
+    )
+    ap.add_argument(
+        "--log-idle",
+        dest="log_idle",
+        type=float,
+        default=300.0,
+        help="close log files not written to for this many seconds. default: 300"
+    )
+    ap.add_argument(
+        "--flood-rate",
+        dest="flood_rate",
+        type=float,
+        default=0.0,
+        help="max lines per second from every host, excess lines are dropped. default: 0 (off)"
+    )
+    ap.add_argument(
+        "--flood-burst",
+        dest="flood_burst",
+        type=float,
+        default=None,
+        help="lines allowed in a burst above --flood-rate, at least 1. default: same as rate"
+    )
+    ap.add_argument(
+        "--flood-limit",
+        dest="flood_limits",
+        action="append",
+        default=None,
+        help=(
+            "host specific rate limit, format: GLOB=RATE[:BURST], "
+            "for example koerkana1_*=500:2000. can be repeated, first match is used"
+        )
+    )
+    ap.add_argument(
+        "--flood-summary",
+        dest="flood_summary",
+        type=float,
+        default=10.0,
+        help="interval of the 'suppressed N lines' summaries in seconds. default: 10"
+    )
     ap.add_argument(
         "--debug",
         dest="debug",
@@ -208,8 +451,23 @@ def main():
         default=False,
         help="write incoming messages to stdout"
     )
+    ap.add_argument(
+        "--profile",
+        dest="profile",
+        default=None,
+        help="profile from start, write pstats to this file on exit or SIGUSR1"
+    )
     args = ap.parse_args()
-    run(**args.__dict__)
+    try:
+        if args.flood_burst is not None:
+            check_burst(args.flood_burst)
+        for spec in args.flood_limits or []:
+            parse_limit(spec)
+    except ValueError as e:
+        ap.error(str(e))
+    kwargs = args.__dict__
+    kwargs["timer"] = install_profiling(kwargs.pop("profile"))
+    run(**kwargs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+"""profiling.py: signal controlled profiling of a running process.
+
+SIGUSR1 starts a cProfile capture, the next SIGUSR1 stops it and dumps the pstats to a file.
+SIGUSR2 logs the wall-clock time spent in the phases of the main loop, measured by PhaseTimer.
+
+    timer = profiling.install(args.profile)
+    while 1:
+        t = timer.start()
+        data = read()
+        t = timer.lap("read", t)
+        write(data)
+        t = timer.lap("write", t)
+"""
+
+import os
+import time
+import signal
+import atexit
+import cProfile
+
+import logging
+
+__license__ = "MIT"
+
+
+log = logging.getLogger(__name__)
+
+
+class PhaseTimer(object):
+    """ Accumulate call counts and wall-clock time for named phases. Cheap enough to be always on. """
+
+    def __init__(self):
+        self.phases = {}  # phase: [count, total seconds, max seconds]
+        self.t_reset = time.time()
+
+    @staticmethod
+    def start():
+        return time.time()
+
+    def lap(self, phase, since):
+        """ Add the time from since to now to the phase, returns now for the next lap. """
+        t = time.time()
+        dt = t - since
+        p = self.phases.get(phase)
+        if p is None:
+            self.phases[phase] = [1, dt, dt]
+        else:
+            p[0] += 1
+            p[1] += dt
+            if dt > p[2]:
+                p[2] = dt
+        return t
+
+    def report(self):
+        elapsed = time.time() - self.t_reset
+        lines = ["phase timings for the last %.1f s:" % elapsed]
+        for phase, (count, total, longest) in sorted(self.phases.items(), key=lambda p: -p[1][1]):
+            lines.append("  %-10s %10d calls %10.3f s %5.1f%% avg %8.3f ms max %8.3f ms" % (
+                phase, count, total, 100.0 * total / elapsed if elapsed else 0.0,
+                1000.0 * total / count, 1000.0 * longest))
+        return "\n".join(lines)
+
+    def reset(self):
+        self.phases = {}
+        self.t_reset = time.time()
+
+
+class Profiler(object):
+    """ cProfile capture that can be toggled, dumps stats to filename when stopped. """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = "nanoprintf-%d.pstats" % os.getpid()
+        self.filename = filename
+        self.profile = None
+
+    def start(self):
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            log.info("profiling started")
+
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.filename)
+            self.profile = None
+            log.info("profiling stopped, stats written to %s", self.filename)
+
+    def toggle(self):
+        if self.profile is None:
+            self.start()
+        else:
+            self.stop()
+
+
+def install(profile=None):
+    """
+    Install the signal handlers, returns the PhaseTimer for the main loop.
+    With a profile filename the cProfile capture is started right away and dumped at exit.
+    The reports are logged at INFO level, to stderr if the process has not configured logging.
+    """
+    if not logging.getLogger().handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)-5s: %(message)s"))
+        log.addHandler(handler)
+        log.propagate = False
+    if not log.isEnabledFor(logging.INFO):
+        log.setLevel(logging.INFO)
+
+    timer = PhaseTimer()
+    profiler = Profiler(profile)
+
+    def dump_timer(signum, frame):
+        log.info(timer.report())
+        timer.reset()
+
+    # the signals do not exist on windows
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggle())
+        signal.signal(signal.SIGUSR2, dump_timer)
+
+    if profile is not None:
+        profiler.start()
+        atexit.register(profiler.stop)
+
+    return timer
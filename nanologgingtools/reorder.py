@@ -0,0 +1,68 @@
+"""reorder.py: merge loglines from several sources in timestamp order."""
+
+import time
+import heapq
+import datetime
+
+__license__ = "MIT"
+
+
+def line_timestr(msg):
+    """ "hostname_n 123ABC x2014-01-14T14:43:21.23Z line" -> "2014-01-14T14:43:21.23Z" """
+    try:
+        return msg.split(None, 3)[2].lstrip("x")
+    except IndexError:
+        return ""
+
+
+class ReorderBuffer(object):
+    """
+    Hold incoming lines for up to window seconds and release them ordered by their
+    embedded timestamps. The heap merges the streams of all the upstream servers,
+    which are each already in order, so a small window is enough.
+
+    A line is released when its timestamp is older than the window. Timestamps ahead of the
+    arrival time (an upstream clock running ahead) are ordered by the arrival time instead,
+    so every line is delayed at most by the window. When more than maxsize lines are held,
+    the oldest are released right away.
+    """
+
+    def __init__(self, window=1.0, maxsize=100000):
+        self.window = window
+        self.maxsize = maxsize
+        self.heap = []
+        self.counter = 0  # keeps lines with equal timestamps in arrival order
+
+    def __len__(self):
+        return len(self.heap)
+
+    def put(self, msg, t=None):
+        if t is None:
+            t = time.time()
+        key = min(line_timestr(msg), _timestr(t))
+        heapq.heappush(self.heap, (key, self.counter, msg))
+        self.counter += 1
+
+    def pop_ready(self, t=None):
+        """ List of lines that are ready to be released, in timestamp order. """
+        if t is None:
+            t = time.time()
+        watermark = _timestr(t - self.window)
+        out = []
+        while self.heap:
+            if self.heap[0][0] > watermark and len(self.heap) <= self.maxsize:
+                break
+            out.append(heapq.heappop(self.heap)[2])
+        return out
+
+    def drain(self):
+        """ Release all held lines, in timestamp order. Call this on shutdown. """
+        out = []
+        while self.heap:
+            out.append(heapq.heappop(self.heap)[2])
+        return out
+
+
+def _timestr(t):
+    """ Unix time -> '2014-01-14T14:43:21.230000', comparable with the line timestamps """
+    return datetime.datetime.utcfromtimestamp(t).strftime("%Y-%m-%dT%H:%M:%S.%f")
@@ -6,9 +6,10 @@ import time
 from datetime import datetime
 
 from elasticsearch import Elasticsearch
-from nanomsg import Socket, PUB, SUB, REP, SUB_SUBSCRIBE
-from nanomsg import SOL_SOCKET, RECONNECT_IVL, RECONNECT_IVL_MAX, DONTWAIT, NanoMsgAPIError
+from nanomsg import DONTWAIT, NanoMsgAPIError
 
+from nanologgingtools.client import make_subscriber
+from nanologgingtools.profiling import PhaseTimer, install as install_profiling
 from .sensed_translator.nuggets import nuggets
 
 # from interrupt_handler import bind_signals
@@ -18,7 +19,8 @@ ELASTICS_INDEX = 'printf'
 
 class PrintfElasticForwarder(object):
 
-    def __init__(self, addr_subscribe, addr_elastic, bind):
+    def __init__(self, addr_subscribe, addr_elastic, bind, timer=None):
+        self.timer = timer if timer is not None else PhaseTimer()
         self.log = logging.getLogger(__name__)
         self.log.setLevel(logging.DEBUG)
         self.log.addHandler(logging.StreamHandler())
@@ -30,16 +32,32 @@ class PrintfElasticForwarder(object):
         self.log.info("[*] Waiting for messages. To exit press CTRL+C")
         soc_sub = self.make_nanomsg_connection()
         elastic = self.make_elastic_connection()
+        while 1:
+            tp = self.timer.start()
+            msg = self.recv(soc_sub, DONTWAIT)
+            tp = self.timer.lap("read", tp)
+            if msg is None:  # idle, wait for the next message outside of the timed phases
+                msg = self.recv(soc_sub)
+                if msg is None:
+                    break
+                tp = self.timer.start()
+            if msg:
+                self.handle_message(msg, elastic)
+                self.timer.lap("send", tp)
+
+    @staticmethod
+    def recv(soc_sub, flags=0):
+        """ Returns None if no message is available, retries when interrupted by a signal. """
         while 1:
             try:
-                msg = soc_sub.recv()
+                return soc_sub.recv(flags=flags)
             except NanoMsgAPIError as e:
-                if e.errno == errno.EAGAIN:
-                    break
+                if e.errno == errno.EINTR:  # SIGUSR1/SIGUSR2 from the profiler
+                    continue
+                elif e.errno == errno.EAGAIN:
+                    return None
                 else:
                     raise
-            if msg:
-                self.handle_message(msg, elastic)
 
     def make_elastic_connection(self):
         if self.addr_elastic:
@@ -57,17 +75,7 @@ class PrintfElasticForwarder(object):
 
     def make_nanomsg_connection(self):
         if self.addr_subscribe and self.addr_subscribe.lower() != "none":
-            soc_sub = Socket(SUB)
-            soc_sub.set_string_option(SUB, SUB_SUBSCRIBE, "")
-            # start reconnecting after one second pause
-            # max reconnect timer to 30 seconds
-            soc_sub.set_int_option(SOL_SOCKET, RECONNECT_IVL, 1000)
-            soc_sub.set_int_option(SOL_SOCKET, RECONNECT_IVL_MAX, 1000 * 30)
-            if self.bind_instead_of_connecting:
-                soc_sub.bind(self.addr_subscribe)
-            else:
-                soc_sub.connect(self.addr_subscribe)
-            return soc_sub
+            return make_subscriber(self.addr_subscribe, bind=self.bind_instead_of_connecting)
         raise Exception("Could not connect to nanomsg")
 
     def handle_message(self, msg, elastic):
@@ -115,6 +123,7 @@ if __name__ == "__main__":
     ap.add_argument("addr_subscribe", help="Pull messages from nanoprintf-server, format is: tcp://host:14998")
     ap.add_argument("addr_elastic",   help="Push messages to elasticsearch, format is: http://host:9200")
     ap.add_argument("--bind", help="Bind to pub socket instead of connecting", default=False, action='store_true')
+    ap.add_argument("--profile", help="Profile from start, write pstats to this file on exit or SIGUSR1", default=None)
     args = ap.parse_args()
-    elfw = PrintfElasticForwarder(**args.__dict__)
+    elfw = PrintfElasticForwarder(args.addr_subscribe, args.addr_elastic, args.bind, install_profiling(args.profile))
     elfw.run()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python2
+"""
+Columnar store of the sensed N- nuggets, for analysis over long periods without parsing the logs again.
+
+Every nugget type gets a directory per day with one file per column:
+    <store>/N-etx/2015-01-16/timestamp.d
+    <store>/N-etx/2015-01-16/host.i
+    <store>/N-etx/2015-01-16/node.i
+    <store>/N-etx/2015-01-16/index.i
+    ...
+The files are plain native arrays, the extension is the array typecode. Hex fields that can not
+be parsed (NO, NO_ROUTE) are stored as -1. Hosts are stored as indexes into <store>/hosts.txt.
+
+Run as a module from the repository root. Subscribe to a nanoprintf-server:
+    python -m nanoprintf-forwarders.nugget_store --store nuggets subscribe tcp://localhost:14998
+Build the store from existing nanoprintf-server log files, days already in the store are skipped
+unless --replace is given:
+    python -m nanoprintf-forwarders.nugget_store --store nuggets backfill log_koerkana1_4.log*
+
+Load for analysis, columns are numpy memmaps when numpy is available:
+    columns = load("nuggets", "N-etx", "2015-01-16")
+    columns["etx"][columns["node"] == 0xE4D8].mean()
+"""
+
+import os
+import sys
+import time
+import shutil
+import array
+import errno
+import logging
+import calendar
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from nanologgingtools.nanoprintf_grep import parse_log_filename, TIMESTAMP_RE
+from .sensed_translator.nuggets import nuggets
+
+log = logging.getLogger(__name__)
+
+TIMESTAMP_TYPE = "d"
+INT_TYPE = "i"
+MISSING = -1
+
+NUGGETS = dict((nugget['prefix'], nugget) for nugget in nuggets)
+
+
+def timestr_to_timestamp(timestr):
+    """timestr format: '2014-02-11T18:46:22.13Z' or '2014-02-11T18:46:22.130Z'"""
+    frac = timestr[19:].rstrip("Z")
+    return calendar.timegm(time.strptime(timestr[:19], "%Y-%m-%dT%H:%M:%S")) + (float("0" + frac) if frac else 0.0)
+
+
+def parse_nugget(text):
+    """
+    "D| CTPRE: 358|N-cbuf 2B45 01 0C" -> ("N-cbuf", {"node": 0x2B45, "used": 1, "capacity": 12})
+    Returns None if the text is not a known nugget.
+    """
+    text = text.rsplit("|", 1)[-1]
+    if not text.startswith("N-"):
+        return None
+    p = text.split()
+    nugget = NUGGETS.get(p[0])
+    if nugget is None:
+        return None
+    values = {}
+    for i, field in enumerate(nugget['fields'][1:], 1):  # skip the header
+        try:
+            values[field] = int(p[i], 16)
+        except (IndexError, ValueError):
+            values[field] = MISSING
+    return nugget['prefix'], values
+
+
+def columns_of(prefix):
+    return ["timestamp", "host"] + NUGGETS[prefix]['fields'][1:]
+
+
+def column_type(column):
+    return TIMESTAMP_TYPE if column == "timestamp" else INT_TYPE
+
+
+class NuggetStore(object):
+    """ Collects decoded nuggets in memory and appends them to the column files in blocks. """
+
+    def __init__(self, root, block=4096):
+        self.root = root
+        self.block = block
+        self.blocks = {}  # (prefix, day): {column: array}
+        self.rows = 0
+        self.hosts = {}
+        self.hostsfile = os.path.join(root, "hosts.txt")
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        for host in load_hosts(root):
+            self.hosts[host] = len(self.hosts)
+
+    def host_id(self, hostname_n):
+        i = self.hosts.get(hostname_n)
+        if i is None:
+            i = len(self.hosts)
+            self.hosts[hostname_n] = i
+            with open(self.hostsfile, "a") as f:
+                f.write(hostname_n + "\n")
+        return i
+
+    def add(self, hostname_n, timestr, text):
+        """ Add a logline, returns True if it was a nugget. """
+        parsed = parse_nugget(text)
+        if parsed is None:
+            return False
+        self.add_nugget(hostname_n, timestr, *parsed)
+        return True
+
+    def add_nugget(self, hostname_n, timestr, prefix, values):
+        values["timestamp"] = timestr_to_timestamp(timestr)
+        values["host"] = self.host_id(hostname_n)
+
+        key = (prefix, timestr[:10])
+        columns = self.blocks.get(key)
+        if columns is None:
+            columns = dict((c, array.array(column_type(c))) for c in columns_of(prefix))
+            self.blocks[key] = columns
+        for column, values_array in columns.items():
+            values_array.append(values[column])
+
+        self.rows += 1
+        if self.rows >= self.block:
+            self.flush()
+
+    def add_message(self, msg):
+        """ msg format: "koerkana1_4 123ABC 2015-01-16T13:25:05.25Z 'N-cbuf 2B45 01 0C'" """
+        hostname_n, seqno, timestr, rest = msg.split(None, 3)
+        if timestr.startswith("x"):  # broken line, timestamp can not be trusted
+            return False
+        return self.add(hostname_n, timestr, rest[1:-1])
+
+    def flush(self):
+        """
+        Append the blocks to the column files. The columns of a day are first cut to their common
+        row count, so a block that was partly written by a failed flush is written again in whole.
+        """
+        for key in list(self.blocks):
+            prefix, day = key
+            columns = self.blocks[key]
+            path = os.path.join(self.root, prefix, day)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            filenames = dict((c, os.path.join(path, "%s.%s" % (c, v.typecode))) for c, v in columns.items())
+            rows = min(row_count(filenames[c], v.typecode) for c, v in columns.items())
+            for column, values in columns.items():
+                with open(filenames[column], "ab") as f:
+                    f.truncate(rows * values.itemsize)
+                    values.tofile(f)
+            del self.blocks[key]
+            self.rows -= len(columns["timestamp"])
+
+    def remove_day(self, prefix, day):
+        """ Drop the stored nuggets of the type and day. """
+        self.blocks.pop((prefix, day), None)
+        shutil.rmtree(os.path.join(self.root, prefix, day), ignore_errors=True)
+
+
+def row_count(filename, typecode):
+    """ Number of whole values in a column file, 0 if it does not exist. """
+    size = os.path.getsize(filename) if os.path.exists(filename) else 0
+    return size // array.array(typecode).itemsize
+
+
+def load_hosts(root):
+    try:
+        with open(os.path.join(root, "hosts.txt")) as f:
+            return [line.rstrip("\n") for line in f]
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+
+def load(root, prefix, day):
+    """
+    Return a dict of column name: array for the nugget type and day. The columns are
+    numpy memmaps if numpy is available, arrays read from the files otherwise.
+    Columns are cut to equal length in case the last block was not completely written.
+    """
+    path = os.path.join(root, prefix, day)
+    columns = {}
+    for column in columns_of(prefix):
+        typecode = column_type(column)
+        filename = os.path.join(path, "%s.%s" % (column, typecode))
+        count = row_count(filename, typecode)
+        if numpy is not None:
+            if count:
+                columns[column] = numpy.memmap(filename, dtype=typecode, mode="r", shape=(count,))
+            else:
+                columns[column] = numpy.zeros(0, dtype=typecode)
+        else:
+            values = array.array(typecode)
+            if count:
+                with open(filename, "rb") as f:
+                    values.fromfile(f, count)
+            columns[column] = values
+    rows = min(len(c) for c in columns.values())
+    return dict((c, values[:rows]) for c, values in columns.items())
+
+
+def days(root, prefix):
+    """ List of the days stored for the nugget type. """
+    path = os.path.join(root, prefix)
+    return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+
+def backfill(store, filenames, replace=False):
+    """
+    Add the nuggets from nanoprintf-server log files to the store. Nugget types and days that
+    are already in the store are skipped, or removed first and stored again with replace.
+    """
+    stored = set((prefix, day) for prefix in NUGGETS for day in days(store.root, prefix))
+    skipped = set()
+    for filename in filenames:
+        parsed = parse_log_filename(filename)
+        if parsed is None:
+            log.warning("skipping %s, not a nanoprintf-server log file", filename)
+            continue
+        hostname_n = parsed[0]
+        count = 0
+        with open(filename, "rb") as f:
+            for line in f:
+                line = line.rstrip(b"\r\n")
+                if TIMESTAMP_RE.match(line) is None or line.startswith(b"x"):
+                    continue
+                timestr, rest = line.decode("utf-8", "replace").split(None, 1)
+                parsed = parse_nugget(rest[1:-1])
+                if parsed is None:
+                    continue
+                key = (parsed[0], timestr[:10])
+                if key in stored:
+                    if not replace:
+                        skipped.add(key)
+                        continue
+                    store.remove_day(*key)
+                    stored.discard(key)
+                store.add_nugget(hostname_n, timestr, *parsed)
+                count += 1
+        log.info("%s: %d nuggets", filename, count)
+    store.flush()
+    for prefix, day in sorted(skipped):
+        log.warning("%s %s was already stored, skipped, see --replace", prefix, day)
+
+
+def subscribe(store, addr_subscribe, flush_interval=10.0):
+    from nanomsg import DONTWAIT, NanoMsgAPIError
+    from nanologgingtools.client import make_subscriber
+
+    soc_sub = make_subscriber(addr_subscribe)
+
+    t_flush = time.time()
+    try:
+        while 1:
+            msg = None
+            try:
+                msg = soc_sub.recv(flags=DONTWAIT)
+            except NanoMsgAPIError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                else:
+                    time.sleep(0.01)
+
+            if msg:
+                try:
+                    store.add_message(msg.decode("utf-8"))
+                except ValueError:
+                    log.exception("error parsing msg: %s", msg)
+
+            if time.time() - t_flush > flush_interval:
+                t_flush = time.time()
+                store.flush()
+    finally:
+        store.flush()
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description="Store sensed nuggets in per type and day column files")
+    ap.add_argument("--store", default="nuggets", help="store directory, default: nuggets")
+    ap.add_argument("--block", default=4096, type=int, help="rows collected in memory before writing")
+    sub = ap.add_subparsers(dest="command")
+    sp = sub.add_parser("subscribe", help="store nuggets from a nanoprintf-server")
+    sp.add_argument("addr_subscribe", help="Pull messages from nanoprintf-server, format is: tcp://host:14998")
+    bp = sub.add_parser("backfill", help="store nuggets from nanoprintf-server log files")
+    bp.add_argument("filenames", nargs="+", help="log files, log_<hostname_n>.log[.YYYY-MM-DD]")
+    bp.add_argument("--replace", default=False, action="store_true",
+                    help="store again the nugget types and days that are already in the store")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)-5s: %(message)s")
+
+    nugget_store = NuggetStore(args.store, args.block)
+    if args.command == "subscribe":
+        subscribe(nugget_store, args.addr_subscribe)
+    elif args.command == "backfill":
+        backfill(nugget_store, args.filenames, args.replace)
+    else:
+        ap.print_help()
+        sys.exit(1)
@@ -13,8 +13,9 @@ import time
 import errno
 import calendar
 
-from nanomsg import Socket, PUB, SUB, REP, SUB_SUBSCRIBE
-from nanomsg import SOL_SOCKET, RECONNECT_IVL, RECONNECT_IVL_MAX, DONTWAIT, NanoMsgAPIError
+from nanomsg import Socket, PUB, DONTWAIT, NanoMsgAPIError
+from nanologgingtools.client import make_subscriber
+from nanologgingtools.profiling import PhaseTimer, install as install_profiling
 from .nuggets import nuggets
 
 def timestr_to_timestamp(timestr):
@@ -56,7 +57,10 @@ def transform_for_sensed(msg):
         log.exception("error parsing msg: %s", msg)
 
 
-def run(addr_forward, addr_subscribe):
+def run(addr_forward, addr_subscribe, timer=None):
+
+    if timer is None:
+        timer = PhaseTimer()
 
     log.info("subscribing for messages to      : %s", addr_subscribe)
     log.info("forwarding messages to PUB       : %s", addr_forward)
@@ -67,13 +71,7 @@ def run(addr_forward, addr_subscribe):
     soc_pub = Socket(PUB)
     soc_pub.bind(addr_forward)
 
-    soc_sub = Socket(SUB)
-    soc_sub.set_string_option(SUB, SUB_SUBSCRIBE, "")
-    # start reconnecting after one second pause
-    # max reconnect timer to 30 seconds
-    soc_sub.set_int_option(SOL_SOCKET, RECONNECT_IVL, 1000)
-    soc_sub.set_int_option(SOL_SOCKET, RECONNECT_IVL_MAX, 1000 * 30)
-    soc_sub.connect(addr_subscribe)
+    soc_sub = make_subscriber(addr_subscribe)
 
     while 1:
         # read from addr_subscribe and forward to addr_forward
@@ -81,21 +79,26 @@ def run(addr_forward, addr_subscribe):
         if soc_sub:
 
             msg = None
+            tp = timer.start()
             try:
                 msg = soc_sub.recv(flags=DONTWAIT)
             except NanoMsgAPIError as e:
                 if e.errno != errno.EAGAIN:
                     raise
-                else:
-                    time.sleep(0.01)
+            tp = timer.lap("read", tp)
+
+            if msg is None:
+                time.sleep(0.01)  # idle, not counted in the read phase
 
             if msg:
                 #hostname_n, rest = msg.split(None, 1)
                 print(msg)
 
                 msg2 = transform_for_sensed(msg)
+                tp = timer.lap("parse", tp)
                 if msg2:
                     soc_pub.send(msg2)
+                    timer.lap("publish", tp)
 
 
 if __name__ == "__main__":
@@ -104,5 +107,6 @@ if __name__ == "__main__":
     ap.add_argument("--forward", dest="addr_forward", default="tcp://*:55555", help="sensed connects here. default: tcp://*:55555")
     ap.add_argument("--subscribe", dest="addr_subscribe", default="tcp://localhost:14998",
                     help="pull messages from this nanoprintf-server. default: tcp://localhost:14998")
+    ap.add_argument("--profile", default=None, help="profile from start, write pstats to this file on exit or SIGUSR1")
     args = ap.parse_args()
-    run(**args.__dict__)
+    run(args.addr_forward, args.addr_subscribe, install_profiling(args.profile))
@@ -20,5 +20,5 @@ setup(name='nano-logging-tools',
       platforms=["any"],
       packages=find_packages(),
       install_requires=['nanomsg', 'pyserial'],
-      scripts=[pjoin('bin', 'nanoprintf-logger'), pjoin('bin', 'nanoprintf-server')],
+      scripts=[pjoin('bin', 'nanoprintf-logger'), pjoin('bin', 'nanoprintf-server'), pjoin('bin', 'nanoprintf-grep')],
       zip_safe=False)